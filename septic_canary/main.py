@@ -1,13 +1,20 @@
+import asyncio
+from base64 import b64encode
 from functools import lru_cache
+import hashlib
 import logging
 import secrets
 import time
-from typing import Callable, Optional
+from typing import Optional
 
-import requests
-from fastapi import Depends, FastAPI, HTTPException
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from pydantic import BaseModel, BaseSettings
+from cachetools import TTLCache
+import httpx
+import ijson
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from fastapi.security import APIKeyHeader
+from pydantic import BaseModel, BaseSettings, ValidationError, root_validator
 
 
 class AppSettings(BaseSettings):
@@ -20,8 +27,7 @@ class AppSettings(BaseSettings):
     house_canary_api_key: str
     house_canary_api_secret: str
 
-    api_username: str
-    api_password: str
+    api_key: str
 
     class Config:
         env_file = ".env"
@@ -44,94 +50,369 @@ def get_now() -> int:
     return int(time.time())
 
 
-class PropertyDetails(BaseModel):
+class PropertyQuery(BaseModel):
     """
-    PropertyDetails models all information about a property returned by this service.
+    PropertyQuery models the parameters used to locate a property.
+
+    `street` must be provided, along with either `zip` or both `city` and `state`.
+    The combination rule is enforced here so FastAPI rejects unresolvable queries
+    with a 422 before the request reaches the route handler.
     """
-    has_septic_system: bool
+    street: str
+    unit: Optional[str] = None
+    city: Optional[str] = None
+    state: Optional[str] = None
+    zip: Optional[int] = None
 
+    @root_validator
+    def _check_resolvable(cls, values):
+        if not values.get("zip") and not (values.get("city") and values.get("state")):
+            raise ValueError("either 'zip' or both 'city' and 'state' must be specified")
+        return values
 
-logger = logging.getLogger("uvicorn")
-app = FastAPI()
-security = HTTPBasic()
 
-@app.get("/api/v1/property/details")
-def property_details(
+def get_property_query(
         street: str,
         unit: Optional[str] = None,
         city: Optional[str] = None,
         state: Optional[str] = None,
         zip: Optional[int] = None,
-        settings: AppSettings = Depends(get_settings),
-        credentials: HTTPBasicCredentials = Depends(security),
-        get_current_time: Callable[[], int] = Depends(get_now),
-) -> PropertyDetails:
+) -> PropertyQuery:
     """
-    Look up details about a requested property.
+    Parse and validate the query params identifying a property.
 
-    `address` must be provided, along with either `zip` or both `city` and `state`.
+    Validation errors are re-raised in the form FastAPI translates into a 422 response.
+    """
+    try:
+        return PropertyQuery(street=street, unit=unit, city=city, state=state, zip=zip)
+    except ValidationError as e:
+        raise RequestValidationError(e.raw_errors)
 
-    :param street: Street address of the property
-    :param unit: Unit of the property within the building at `street`
-    :param city: City containing the property
-    :param state: State containing the property
-    :param zip: ZIP code containing the property
-    :param settings: Application settings
-    :param credentials: HTTP Basic credentials passed in the request
-    :param get_current_time: No-arg function that returns the current UTC epoch in seconds
-    :return: Details about the specified property
+
+class PropertyDetails(BaseModel):
+    """
+    PropertyDetails models all information about a property returned by this service.
+    """
+    has_septic_system: bool
+
+
+# Path of the HouseCanary details API, relative to the shared client's base URL.
+_DETAILS_PATH = "/v2/property/details"
+
+# Seconds between keep-alive pings to HouseCanary.
+_KEEPALIVE_INTERVAL = 60.0
+
+logger = logging.getLogger("uvicorn")
+
+
+class APIKeyMiddleware:
+    """
+    Pure-ASGI middleware that authenticates requests before they reach the router.
+
+    Rejecting bad credentials here means unauthorized callers never pay for (or get to
+    probe) FastAPI's dependency resolution and query validation. Only paths under
+    `/api/` are guarded, leaving the OpenAPI docs reachable.
+    """
+    def __init__(self, app):
+        self.asgi_app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/api/"):
+            given_key = None
+            for name, value in scope["headers"]:
+                if name == b"x-api-key":
+                    given_key = value
+                    break
+            if given_key is None or not secrets.compare_digest(
+                hashlib.blake2b(given_key, digest_size=32).digest(),
+                scope["app"].state.api_key_hash,
+            ):
+                response = ORJSONResponse({"detail": "Unauthorized"}, status_code=401)
+                await response(scope, receive, send)
+                return
+        await self.asgi_app(scope, receive, send)
+
+
+# orjson serializes responses several times faster than the stdlib json module used by
+# FastAPI's default JSONResponse.
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(APIKeyMiddleware)
+
+# Declared on the route purely so the X-API-Key scheme shows up in the OpenAPI schema
+# (and Swagger UI's Authorize button); enforcement happens in APIKeyMiddleware, so this
+# must not auto-error.
+api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
+
+# Cache of recent successful lookups, keyed by normalized lookup params. Property details
+# change rarely and HouseCanary is slow (and likely metered), so repeated lookups for the
+# same address within the TTL are served from memory. No lock is needed: the handler runs
+# on the event loop, and the cache is only touched between awaits.
+_details_cache: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+
+# Lookups that are currently in flight, keyed the same way as `_details_cache`. Concurrent
+# requests for the same address share a single upstream call instead of fanning out N
+# duplicates (which matters when HouseCanary starts rate-limiting us).
+_inflight_lookups: dict = {}
+
+
+def _build_http_client(settings: AppSettings) -> httpx.AsyncClient:
+    """
+    Build the shared HTTP client used to talk to HouseCanary.
+
+    The client is created once per process so connections to HouseCanary are
+    pooled and kept alive across requests, and so auth doesn't need to be
+    re-specified on every call. Failures to establish a connection are retried
+    a couple of times before giving up.
+
+    HTTP/2 is enabled (negotiated via ALPN, falling back to HTTP/1.1) so concurrent
+    lookups multiplex over a handful of long-lived connections instead of needing
+    one connection per in-flight request.
     """
-    # Authenticate the request.
-    correct_username = secrets.compare_digest(credentials.username, settings.api_username)
-    correct_password = secrets.compare_digest(credentials.password, settings.api_password)
-    if not (correct_username and correct_password):
-        raise HTTPException(status_code=401, detail="Unauthorized", headers={"WWW-Authenticate": "Basic"})
-
-    # Check we have enough information to locate the property.
-    if not zip and not (city and state):
-        raise HTTPException(status_code=422, detail="either 'zip' or both 'city' and 'state' must be specified")
-
-    # Filter out any unset/empty parameters.
-    lookup_params = dict(
-        (k, v) for k, v in
-        [("address", street), ("unit", unit), ("city", city), ("state", state), ("zipcode", zip)]
-        if v
+    # Precompute the Basic auth header: passing `auth=` instead would re-run httpx's
+    # auth flow (and re-encode the credentials) on every request.
+    auth_header = "Basic " + b64encode(
+        f"{settings.house_canary_api_key}:{settings.house_canary_api_secret}".encode()
+    ).decode()
+    return httpx.AsyncClient(
+        base_url=settings.house_canary_api_base_url,
+        headers={"Authorization": auth_header},
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+        ),
+        timeout=30.0,
     )
 
-    # Request details from HomeCanary.
-    res = requests.get(
-        f"{settings.house_canary_api_base_url}/v2/property/details",
-        params=lookup_params,
-        auth=(settings.house_canary_api_key, settings.house_canary_api_secret),
+
+async def _keep_connections_warm(http: httpx.AsyncClient):
+    """
+    Periodically ping HouseCanary so pooled connections aren't closed for idleness.
+
+    Pings are best-effort: if one fails, the next real request just pays to reconnect.
+    """
+    while True:
+        await asyncio.sleep(_KEEPALIVE_INTERVAL)
+        try:
+            await http.head("/", timeout=2.0)
+        except httpx.HTTPError:
+            pass
+
+
+@app.on_event("startup")
+async def initialize_app_state():
+    """
+    Resolve settings and create the shared HouseCanary client when the app starts.
+
+    Settings are stashed on `app.state` so the route can read them directly instead of
+    paying for dependency resolution on every request.
+    """
+    settings = get_settings()
+    app.state.settings = settings
+    app.state.http = _build_http_client(settings)
+    # Store only a digest of the expected API key, so auth is a fixed-size (32-byte)
+    # constant-time comparison per request.
+    app.state.api_key_hash = hashlib.blake2b(settings.api_key.encode(), digest_size=32).digest()
+
+    # Warm the connection pool so the first real request doesn't pay for DNS + TLS setup,
+    # then keep the pooled connections alive in the background.
+    try:
+        await app.state.http.head("/", timeout=2.0)
+    except httpx.HTTPError:
+        logger.warning("Failed to warm up connection to HouseCanary")
+    app.state.keepalive_task = asyncio.create_task(_keep_connections_warm(app.state.http))
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """
+    Tear down the keep-alive task and shared HouseCanary client when the app stops.
+    """
+    app.state.keepalive_task.cancel()
+    try:
+        await app.state.keepalive_task
+    except asyncio.CancelledError:
+        pass
+    await app.state.http.aclose()
+
+
+def _cache_key(lookup_params: dict) -> tuple:
+    """
+    Build the cache key for a set of lookup params.
+
+    Casing is normalized so e.g. "123 Main St" and "123 MAIN ST" share an entry.
+    """
+    return tuple(
+        sorted((k, v.casefold() if isinstance(v, str) else v) for k, v in lookup_params.items())
     )
-    if res.status_code != 200:
-        logger.error("Request to HouseCanary failed: %s", res.json())
-
-        # Pass rate-limit errors through to the client so they know to back off.
-        if res.status_code == 429:
-            # HouseCanary returns `X-RateLimit-Reset: <UTC-epoch-second when it's OK to retry>`.
-            # A more standard response would be `Retry-After: <seconds to wait before retrying>`
-            # We translate between the two forms.
-            limit_reset_time = int(res.headers["X-RateLimit-Reset"])
-            now = get_current_time()
-            retry_after = limit_reset_time - now
-            raise HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": retry_after})
-
-        # Otherwise report an internal server error, as any other error code means we sent HomeCanary a
-        # malformed/mis-authenticated request.
-        raise HTTPException(
-            status_code=500,
-            detail="an error occurred while looking up property details, see server logs for more info",
-        )
-    res_body = res.json()
+
+
+async def _lookup_details(http: httpx.AsyncClient, lookup_params: dict, now: int) -> PropertyDetails:
+    """
+    Look up property details via HouseCanary, going through the in-process cache.
+
+    Concurrent calls with the same params are coalesced: the first call fires the
+    upstream request, and the rest await its result.
+
+    :param http: Shared HTTP client pointed at HouseCanary
+    :param lookup_params: Query params identifying the property to look up
+    :param now: Current UTC epoch in seconds, used to compute rate-limit backoff
+    :return: Details about the specified property
+    """
+    # Serve repeated lookups for the same address from the in-process cache.
+    cache_key = _cache_key(lookup_params)
+    cached_details = _details_cache.get(cache_key)
+    if cached_details is not None:
+        return cached_details
+
+    # If an identical lookup is already in flight, share its result instead of firing a
+    # duplicate upstream call.
+    pending = _inflight_lookups.get(cache_key)
+    if pending is not None:
+        return await pending
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight_lookups[cache_key] = fut
+    try:
+        details = await _fetch_details(http, lookup_params, now)
+    except BaseException as exc:
+        fut.set_exception(exc)
+        # Mark the exception as retrieved, in case no other call is awaiting the future.
+        fut.exception()
+        raise
+    else:
+        fut.set_result(details)
+        _details_cache[cache_key] = details
+        return details
+    finally:
+        del _inflight_lookups[cache_key]
+
+
+class _AsyncStreamReader:
+    """
+    Minimal async file-like wrapper exposing a streamed httpx response to ijson.
+    """
+    def __init__(self, res: httpx.Response):
+        self._chunks = res.aiter_bytes()
+
+    async def read(self, size: int = -1) -> bytes:
+        # ijson probes with read(0) to sniff bytes vs str; don't consume anything for it.
+        if size == 0:
+            return b""
+        # Otherwise ijson only requires that successive reads eventually drain the
+        # stream, so returning whatever-sized chunk comes off the wire is fine.
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+
+async def _fetch_details(http: httpx.AsyncClient, lookup_params: dict, now: int) -> PropertyDetails:
+    """
+    Query HouseCanary for property details and translate the response.
+
+    :param http: Shared HTTP client pointed at HouseCanary
+    :param lookup_params: Query params identifying the property to look up
+    :param now: Current UTC epoch in seconds, used to compute rate-limit backoff
+    :return: Details about the specified property
+    """
+    # Request details from HomeCanary, streaming the body so we only pay to parse the
+    # parts of the (large) property dossier that we actually read.
+    async with http.stream("GET", _DETAILS_PATH, params=lookup_params) as res:
+        if res.status_code != 200:
+            # Log the raw (truncated) body rather than parsing it: error bodies only feed
+            # this log line, and they aren't guaranteed to be JSON anyway.
+            await res.aread()
+            logger.error("Request to HouseCanary failed: status=%d body=%s", res.status_code, res.text[:512])
+
+            # Pass rate-limit errors through to the client so they know to back off.
+            if res.status_code == 429:
+                # HouseCanary returns `X-RateLimit-Reset: <UTC-epoch-second when it's OK to retry>`.
+                # A more standard response would be `Retry-After: <seconds to wait before retrying>`
+                # We translate between the two forms.
+                # Clamped at zero in case clock skew puts the reset time in our past.
+                limit_reset_time = int(res.headers["X-RateLimit-Reset"])
+                retry_after = max(0, limit_reset_time - now)
+                raise HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": str(retry_after)})
+
+            # Otherwise report an internal server error, as any other error code means we sent HomeCanary a
+            # malformed/mis-authenticated request.
+            raise HTTPException(
+                status_code=500,
+                detail="an error occurred while looking up property details, see server logs for more info",
+            )
+
+        # Pull just the two fields we care about out of the dossier, stopping as soon as
+        # both have been seen (or as soon as we know the address didn't resolve).
+        address_matched = None
+        sewer = None
+        try:
+            async for prefix, _, value in ijson.parse(_AsyncStreamReader(res)):
+                if prefix == "address_info.status.match":
+                    address_matched = value
+                    if not address_matched:
+                        break
+                elif prefix == "property/details.result.property.sewer":
+                    sewer = value
+                if address_matched is not None and sewer is not None:
+                    break
+        except ijson.JSONError:
+            logger.error("HouseCanary returned unparseable JSON")
+            raise HTTPException(status_code=502, detail="received a malformed response from HouseCanary")
 
     # Check the HomeCanary response to see if it was able to resolve the address.
-    resolution_status = res_body["address_info"]["status"]
-    if not bool(resolution_status["match"]):
+    if not address_matched:
         raise HTTPException(status_code=404, detail="could not resolve address using given parameters")
 
-    # Extract the specific details we care about from the response.
-    property_details = res_body["property/details"]["result"]["property"]
-    property_has_septic_system = "sewer" in property_details and property_details["sewer"].lower() == "septic"
+    # The length check rejects most non-septic values before paying for the lowercased copy.
+    property_has_septic_system = isinstance(sewer, str) and len(sewer) == 6 and sewer.lower() == "septic"
+
+    # The value is a bool we computed ourselves, so skip Pydantic validation.
+    return PropertyDetails.construct(has_septic_system=property_has_septic_system)
+
+
+# No response_model here: declaring one would make FastAPI re-validate the returned
+# model per response, defeating the construct() call in _fetch_details.
+@app.get("/api/v1/property/details", response_class=ORJSONResponse)
+async def property_details(
+        request: Request,
+        response: Response,
+        query: PropertyQuery = Depends(get_property_query),
+        api_key: Optional[str] = Depends(api_key_header),
+        now: int = Depends(get_now),
+):
+    """
+    Look up details about a requested property.
+
+    :param request: Raw incoming request, used to reach the shared HTTP client
+    :param response: Outgoing response, used to attach cache headers
+    :param query: Parameters identifying the property to look up
+    :param api_key: API key from the `X-API-Key` header; only declared so the auth
+        scheme appears in the OpenAPI schema
+    :param now: Current UTC epoch in seconds
+    :return: Details about the specified property
+    """
+    # Authentication already happened in APIKeyMiddleware, before routing.
+
+    # Build the upstream params, skipping any unset/empty parameters.
+    lookup_params = {"address": query.street}
+    if query.unit:
+        lookup_params["unit"] = query.unit
+    if query.city:
+        lookup_params["city"] = query.city
+    if query.state:
+        lookup_params["state"] = query.state
+    if query.zip:
+        lookup_params["zipcode"] = query.zip
+
+    # A property's details are effectively static, so let clients and CDNs cache
+    # responses for a day. The ETag is derived from the normalized lookup params, so a
+    # client revalidating with If-None-Match can be answered without touching upstream.
+    etag = hashlib.md5(repr(_cache_key(lookup_params)).encode()).hexdigest()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
 
-    return PropertyDetails(has_septic_system=property_has_septic_system)
+    details = await _lookup_details(request.app.state.http, lookup_params, now)
+    response.headers["Cache-Control"] = "public, max-age=86400"
+    response.headers["ETag"] = etag
+    return details
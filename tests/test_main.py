@@ -1,11 +1,10 @@
+import asyncio
 from base64 import b64encode
-import json
 import time
 
-from fastapi import HTTPException
-from fastapi.security import HTTPBasicCredentials
+from fastapi.testclient import TestClient
+import httpx
 import pytest
-from requests_mock import Mocker
 
 from septic_canary import main
 
@@ -13,72 +12,218 @@ settings = main.AppSettings(
     house_canary_api_base_url='http://base.url',
     house_canary_api_key='foo',
     house_canary_api_secret='bar',
-    api_username='me',
-    api_password='supersecretplsnotell'
+    api_key='supersecretplsnotell'
 )
 encoded_auth = b64encode(f"{settings.house_canary_api_key}:{settings.house_canary_api_secret}".encode()).decode()
-good_creds = HTTPBasicCredentials(username=settings.api_username, password=settings.api_password)
+good_auth_headers = {"X-API-Key": settings.api_key}
 
 
-def get_details(**kwargs):
-    return main.property_details(settings=settings, credentials=good_creds, **kwargs)
+class MockUpstream:
+    """
+    Stand-in for the HouseCanary API.
 
+    Tests configure a canned response via `respond_with`, and can inspect the
+    requests that reached the mock via `requests`.
+    """
+    def __init__(self):
+        self.status_code = 200
+        self.body = {}
+        self.text = None
+        self.response_headers = {}
+        self.requests = []
 
-def test_get_property_details_with_septic(requests_mock: Mocker):
-    requests_mock.get(
-        f"{settings.house_canary_api_base_url}/v2/property/details?address=123+Street&zipcode=98765",
-        request_headers={"Authorization": f"Basic {encoded_auth}"},
-        text=json.dumps({
-            "address_info": {
-                "status": {
-                    "match": True,
-                }
-            },
-            "property/details": {
-                "api_code": 0,
-                "result": {
-                    "property": {
-                        "sewer": "Septic"
-                    }
+    def respond_with(self, body=None, status_code=200, headers=None, text=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = text
+        self.response_headers = headers or {}
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        # Ignore the HEAD pings the app sends to warm up / keep alive its connection
+        # pool; tests only care about real lookups.
+        if request.method != "HEAD":
+            self.requests.append(request)
+        if self.text is not None:
+            return httpx.Response(self.status_code, text=self.text, headers=self.response_headers)
+        return httpx.Response(self.status_code, json=self.body, headers=self.response_headers)
+
+
+@pytest.fixture
+def upstream() -> MockUpstream:
+    return MockUpstream()
+
+
+@pytest.fixture
+def client(monkeypatch, upstream: MockUpstream):
+    # Point the app's settings at test values; startup stashes them on app.state.
+    monkeypatch.setattr(main, "get_settings", lambda: settings)
+    # Swap the real HouseCanary client for one backed by the mock upstream.
+    monkeypatch.setattr(
+        main,
+        "_build_http_client",
+        lambda s: httpx.AsyncClient(
+            base_url=s.house_canary_api_base_url,
+            auth=(s.house_canary_api_key, s.house_canary_api_secret),
+            transport=httpx.MockTransport(upstream.handle),
+        ),
+    )
+    main._details_cache.clear()
+    with TestClient(main.app) as test_client:
+        yield test_client
+    main.app.dependency_overrides.clear()
+
+
+def get_details(client: TestClient, headers=None, **params) -> httpx.Response:
+    return client.get(
+        "/api/v1/property/details",
+        params=params,
+        headers={**good_auth_headers, **(headers or {})},
+    )
+
+
+def assert_upstream_requested(upstream: MockUpstream, expected_params: dict):
+    assert len(upstream.requests) == 1
+    upstream_req = upstream.requests[0]
+    assert dict(upstream_req.url.params) == expected_params
+    assert upstream_req.headers["Authorization"] == f"Basic {encoded_auth}"
+
+
+def test_get_property_details_with_septic(client: TestClient, upstream: MockUpstream):
+    upstream.respond_with({
+        "address_info": {
+            "status": {
+                "match": True,
+            }
+        },
+        "property/details": {
+            "api_code": 0,
+            "result": {
+                "property": {
+                    "sewer": "Septic"
                 }
             }
-        })
-    )
+        }
+    })
 
-    details = get_details(street="123 Street", zip=98765)
-    assert details.has_septic_system
+    res = get_details(client, street="123 Street", zip=98765)
+    assert res.status_code == 200
+    assert res.json()["has_septic_system"]
+    assert_upstream_requested(upstream, {"address": "123 Street", "zipcode": "98765"})
 
 
-def test_get_property_details_without_septic(requests_mock: Mocker):
-    requests_mock.get(
-        f"{settings.house_canary_api_base_url}/v2/property/details?address=123+Street&zipcode=98765",
-        request_headers={"Authorization": f"Basic {encoded_auth}"},
-        text=json.dumps({
-            "address_info": {
-                "status": {
-                    "match": True,
+def test_get_property_details_without_septic(client: TestClient, upstream: MockUpstream):
+    upstream.respond_with({
+        "address_info": {
+            "status": {
+                "match": True,
+            }
+        },
+        "property/details": {
+            "api_code": 0,
+            "result": {
+                "property": {
+                    "sewer": "Yes"
                 }
-            },
-            "property/details": {
-                "api_code": 0,
-                "result": {
-                    "property": {
-                        "sewer": "Yes"
-                    }
+            }
+        }
+    })
+
+    res = get_details(client, street="123 Street", zip=98765)
+    assert res.status_code == 200
+    assert not res.json()["has_septic_system"]
+    assert_upstream_requested(upstream, {"address": "123 Street", "zipcode": "98765"})
+
+
+def test_get_property_details_with_unit_city_state(client: TestClient, upstream: MockUpstream):
+    upstream.respond_with({
+        "address_info": {
+            "status": {
+                "match": True,
+            }
+        },
+        "property/details": {
+            "api_code": 0,
+            "result": {
+                "property": {
+                    "sewer": "Septic"
                 }
             }
-        })
+        }
+    })
+
+    res = get_details(client, street="123 Street", unit="10f", city="Big", state="MA")
+    assert res.status_code == 200
+    assert res.json()["has_septic_system"]
+    assert_upstream_requested(
+        upstream,
+        {"address": "123 Street", "unit": "10f", "city": "Big", "state": "MA"},
     )
 
-    details = get_details(street="123 Street", zip=98765)
-    assert not details.has_septic_system
 
+def test_get_property_details_cached(client: TestClient, upstream: MockUpstream):
+    upstream.respond_with({
+        "address_info": {
+            "status": {
+                "match": True,
+            }
+        },
+        "property/details": {
+            "api_code": 0,
+            "result": {
+                "property": {
+                    "sewer": "Septic"
+                }
+            }
+        }
+    })
+
+    first = get_details(client, street="123 Street", zip=98765)
+    # Differently-cased params should hit the same cache entry.
+    second = get_details(client, street="123 STREET", zip=98765)
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert second.json() == first.json()
+    # Only the first request should have reached HouseCanary.
+    assert len(upstream.requests) == 1
+
+
+def test_get_property_details_not_modified(client: TestClient, upstream: MockUpstream):
+    upstream.respond_with({
+        "address_info": {
+            "status": {
+                "match": True,
+            }
+        },
+        "property/details": {
+            "api_code": 0,
+            "result": {
+                "property": {
+                    "sewer": "Septic"
+                }
+            }
+        }
+    })
+
+    first = get_details(client, street="123 Street", zip=98765)
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "public, max-age=86400"
+    etag = first.headers["ETag"]
+
+    # Revalidating with the returned ETag should yield an empty 304.
+    second = get_details(client, headers={"If-None-Match": etag}, street="123 Street", zip=98765)
+    assert second.status_code == 304
+    assert not second.content
+    assert len(upstream.requests) == 1
 
-def test_get_property_details_with_unit_city_state(requests_mock: Mocker):
-    requests_mock.get(
-        f"{settings.house_canary_api_base_url}/v2/property/details?address=123+Street&unit=10f&city=Big&state=MA",
-        request_headers={"Authorization": f"Basic {encoded_auth}"},
-        text=json.dumps({
+
+def test_lookup_details_coalesces_inflight_requests():
+    upstream_calls = []
+
+    async def slow_handler(request: httpx.Request) -> httpx.Response:
+        upstream_calls.append(request)
+        # Yield to the event loop so the concurrent lookups overlap.
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={
             "address_info": {
                 "status": {
                     "match": True,
@@ -93,81 +238,107 @@ def test_get_property_details_with_unit_city_state(requests_mock: Mocker):
                 }
             }
         })
-    )
 
-    details = get_details(street="123 Street", unit="10f", city="Big", state="MA")
-    assert details.has_septic_system
+    async def run_concurrent_lookups():
+        async with httpx.AsyncClient(
+            base_url=settings.house_canary_api_base_url,
+            transport=httpx.MockTransport(slow_handler),
+        ) as http:
+            params = {"address": "123 Street", "zipcode": 98765}
+            now = int(time.time())
+            return await asyncio.gather(
+                main._lookup_details(http, params, now),
+                main._lookup_details(http, params, now),
+                main._lookup_details(http, params, now),
+            )
 
+    main._details_cache.clear()
+    results = asyncio.run(run_concurrent_lookups())
+    assert all(details.has_septic_system for details in results)
+    # All three lookups should have shared a single upstream call.
+    assert len(upstream_calls) == 1
 
-def test_get_property_details_bad_auth():
-    with pytest.raises(HTTPException) as exc_info:
-        main.property_details(street='', settings=settings,
-                              credentials=HTTPBasicCredentials(username='foo', password='bar'))
-    assert exc_info.value.status_code == 401
 
+def test_get_property_details_bad_auth(client: TestClient, upstream: MockUpstream):
+    res = client.get(
+        "/api/v1/property/details",
+        params={"street": "123 Street", "zip": 98765},
+        headers={"X-API-Key": "not-the-right-key"},
+    )
+    assert res.status_code == 401
 
-def test_get_property_details_missing_params():
-    with pytest.raises(HTTPException) as exc_info:
-        get_details(street="123 Street", city="Big")
-    assert exc_info.value.status_code == 422
+    # Requests missing the header entirely should also be rejected.
+    res = client.get("/api/v1/property/details", params={"street": "123 Street", "zip": 98765})
+    assert res.status_code == 401
+    assert not upstream.requests
 
 
-def test_get_property_details_bad_internal_auth(requests_mock: Mocker):
-    requests_mock.get(
-        f"{settings.house_canary_api_base_url}/v2/property/details?address=123+Street&zipcode=98765",
-        request_headers={"Authorization": f"Basic {encoded_auth}"},
-        status_code=401,
-        text=json.dumps({"message": "Authentication Failed", "code": 401})
-    )
+def test_get_property_details_missing_params(client: TestClient, upstream: MockUpstream):
+    res = get_details(client, street="123 Street", city="Big")
+    assert res.status_code == 422
+    assert not upstream.requests
 
-    with pytest.raises(HTTPException) as exc_info:
-        get_details(street="123 Street", zip=98765)
-    assert exc_info.value.status_code == 500
 
+def test_get_property_details_bad_internal_auth(client: TestClient, upstream: MockUpstream):
+    upstream.respond_with({"message": "Authentication Failed", "code": 401}, status_code=401)
 
-def test_get_property_details_malformed_internal_request(requests_mock: Mocker):
+    res = get_details(client, street="123 Street", zip=98765)
+    assert res.status_code == 500
+
+
+def test_get_property_details_malformed_internal_request(client: TestClient, upstream: MockUpstream):
     # Simulate the HomeCanary API changing out from under us.
-    requests_mock.get(
-        f"{settings.house_canary_api_base_url}/v2/property/details?address=123+Street&zipcode=98765",
-        request_headers={"Authorization": f"Basic {encoded_auth}"},
-        status_code=400,
-        text=json.dumps({"message": "Missing required parameter in the query string"})
-    )
+    upstream.respond_with({"message": "Missing required parameter in the query string"}, status_code=400)
 
-    with pytest.raises(HTTPException) as exc_info:
-        get_details(street="123 Street", zip=98765)
-    assert exc_info.value.status_code == 500
+    res = get_details(client, street="123 Street", zip=98765)
+    assert res.status_code == 500
 
 
-def test_get_property_details_address_fails_resolution(requests_mock: Mocker):
-    requests_mock.get(
-        f"{settings.house_canary_api_base_url}/v2/property/details?address=123+Street&zipcode=98765",
-        request_headers={"Authorization": f"Basic {encoded_auth}"},
-        text=json.dumps({
-            "address_info": {
-                "status": {
-                    "match": False,
-                }
-            },
-        })
-    )
+def test_get_property_details_unparseable_upstream_response(client: TestClient, upstream: MockUpstream):
+    # Simulate e.g. an HTML error page from a proxy in front of HomeCanary.
+    upstream.respond_with(text="<html>not json</html>")
 
-    with pytest.raises(HTTPException) as exc_info:
-        get_details(street="123 Street", zip=98765)
-    assert exc_info.value.status_code == 404
+    res = get_details(client, street="123 Street", zip=98765)
+    assert res.status_code == 502
 
 
-def test_get_property_details_rate_limit(requests_mock: Mocker):
+def test_get_property_details_address_fails_resolution(client: TestClient, upstream: MockUpstream):
+    upstream.respond_with({
+        "address_info": {
+            "status": {
+                "match": False,
+            }
+        },
+    })
+
+    res = get_details(client, street="123 Street", zip=98765)
+    assert res.status_code == 404
+
+
+def test_get_property_details_rate_limit(client: TestClient, upstream: MockUpstream):
     now = int(time.time())
-    requests_mock.get(
-        f"{settings.house_canary_api_base_url}/v2/property/details?address=123+Street&zipcode=98765",
-        request_headers={"Authorization": f"Basic {encoded_auth}"},
+    upstream.respond_with(
+        {"message": "Too Many Requests"},
         status_code=429,
-        text=json.dumps({"message": "Too Many Requests"}),
         headers={"X-RateLimit-Reset": str(now + 1000)},
     )
+    main.app.dependency_overrides[main.get_now] = lambda: now
+
+    res = get_details(client, street="123 Street", zip=98765)
+    assert res.status_code == 429
+    assert int(res.headers["Retry-After"]) == 1000
+
+
+def test_get_property_details_rate_limit_with_clock_skew(client: TestClient, upstream: MockUpstream):
+    now = int(time.time())
+    # Simulate HouseCanary's clock running behind ours.
+    upstream.respond_with(
+        {"message": "Too Many Requests"},
+        status_code=429,
+        headers={"X-RateLimit-Reset": str(now - 50)},
+    )
+    main.app.dependency_overrides[main.get_now] = lambda: now
 
-    with pytest.raises(HTTPException) as exc_info:
-        get_details(street="123 Street", zip=98765, get_current_time=lambda: now)
-    assert exc_info.value.status_code == 429
-    assert int(exc_info.value.headers["Retry-After"]) == 1000
+    res = get_details(client, street="123 Street", zip=98765)
+    assert res.status_code == 429
+    assert res.headers["Retry-After"] == "0"